@@ -25,14 +25,13 @@ def chat():
             'message': 'No text provided'
         }), 400
 
-    # Init session storage
-    conversation_histories.setdefault(session_id, [])
+    # Init session storage (conversation_histories is a defaultdict)
     transcripts.setdefault(session_id, [])
 
     transcripts[session_id].append({'role': 'user', 'text': user_input})
 
     # Get LLM response
-    response = llm.get_response(user_input, conversation_histories[session_id])
+    response = llm.get_response(user_input, conversation_histories[session_id], session_id)
 
     conversation_histories[session_id].append({'role': 'user', 'content': user_input})
     conversation_histories[session_id].append({'role': 'assistant', 'content': response})
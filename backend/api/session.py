@@ -1,5 +1,5 @@
 from flask import Blueprint, request, jsonify
-from backend.state.store import transcripts, feedback
+from backend.state.store import transcripts, feedback, llm
 
 session_bp = Blueprint('session', __name__)
 
@@ -16,6 +16,7 @@ def end_session():
 
     # clear for next session
     transcripts[session_id] = []
+    llm.reset_context(session_id)
 
     return jsonify({
         'status': 'success',
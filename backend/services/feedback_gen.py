@@ -1,9 +1,14 @@
 import json
 import re
+import eventlet
 from typing import List, Dict
 from backend.services.llm_handler import LLMHandler
 from backend.services.schemas import SessionFeedback, VocabCard, SentenceCorrection
 
+# Hoisted so the per-turn language checks skip the re cache lookup
+_RE_LATIN = re.compile(r'[a-zA-Z]')
+_RE_CJK = re.compile(r'[\u4e00-\u9fff]')
+
 
 class FeedbackGenerator:
     def __init__(self, llm_handler: LLMHandler):
@@ -23,35 +28,47 @@ class FeedbackGenerator:
                     sentences_to_fix.append(text)
         
         corrections = []
-        
-        # Process last 3 sentences for feedback
-        for sent in sentences_to_fix:
-            # 1. Get natural correction with highlights from LLM
-            result_data = self.llm.correct_sentence(sent)
-            
+
+        # One LLM round-trip per batch of up to 8 sentences instead of one
+        # per sentence; the green pool (run.py monkey-patches sockets) still
+        # overlaps the HTTP waits when a session needs several batches
+        batches = [sentences_to_fix[i:i + 8]
+                   for i in range(0, len(sentences_to_fix), 8)]
+        pool = eventlet.GreenPool(2)
+        results = [result
+                   for batch in pool.imap(self.llm.correct_sentences, batches)
+                   for result in batch]
+
+        for sent, result_data in zip(sentences_to_fix, results):
             corrected_text = result_data.get('corrected', sent)
             highlights = result_data.get('highlights', [])
             note = result_data.get('note', '')
             
             # 2. Process highlights for vocab cards and text anchoring
             corrected_with_anchors = corrected_text
-            
-            for h in highlights:
-                word = h.get('word', '')
-                why = h.get('why', '')
-                
-                # Skip if word doesn't exist in corrected text (validation)
-                if word not in corrected_text:
-                    continue
-                
-                # Add [[anchors]] for UI highlighting (first occurrence only)
-                # Check if this specific word is already anchored
-                if word in corrected_with_anchors and f"[[{word}]]" not in corrected_with_anchors:
-                    corrected_with_anchors = corrected_with_anchors.replace(
-                        word, 
-                        f"[[{word}]]", 
-                        1  # Only first occurrence
-                    )
+            why = highlights[-1].get('why', '') if highlights else ''
+
+            # Validate words against the corrected text, dropping duplicates
+            words = [w for w in dict.fromkeys(h.get('word', '') for h in highlights)
+                     if w and w in corrected_text]
+            if words:
+                # One pass instead of a replace() scan per highlight.
+                # Longest-first alternation so a highlight containing a
+                # shorter one is anchored whole, not split by the inner match.
+                pattern = re.compile('|'.join(
+                    re.escape(w) for w in sorted(words, key=len, reverse=True)
+                ))
+                pending = set(words)
+
+                def _anchor(match):
+                    word = match.group(0)
+                    if word in pending:
+                        # First occurrence only
+                        pending.discard(word)
+                        return f"[[{word}]]"
+                    return word
+
+                corrected_with_anchors = pattern.sub(_anchor, corrected_text)
 
             # 3. Store the correction (with anchors for UI)
             corrections.append(SentenceCorrection(
@@ -73,27 +90,9 @@ class FeedbackGenerator:
     # helper methods
     def _has_english(self, text: str) -> bool:
         """Check if text contains English"""
-        return bool(re.search(r'[a-zA-Z]', text))
+        return _RE_LATIN.search(text) is not None
     
     def _has_mixed_language(self, text: str) -> bool:
         """Check if text contains both Chinese and English"""
-        has_chinese = bool(re.search(r'[\u4e00-\u9fff]', text))
-        has_english = bool(re.search(r'[a-zA-Z]', text))
-        return has_chinese and has_english
-    
-    def _guess_pinyin(self, word: str) -> str:
-        """
-        Fallback: Generate approximate pinyin for words not in dictionary.
-        Looks up individual characters if multi-character word.
-        """
-        pinyin_parts = []
-        for char in word:
-            entry = self.dictionary.get(char)
-            if entry:
-                # Extract syllable (remove tone numbers if needed)
-                syllable = entry['pinyin'].split()[0] if entry['pinyin'] else char
-                pinyin_parts.append(syllable)
-            else:
-                pinyin_parts.append(char)
-        
-        return ' '.join(pinyin_parts) if pinyin_parts else word
\ No newline at end of file
+        return (_RE_CJK.search(text) is not None
+                and _RE_LATIN.search(text) is not None)
\ No newline at end of file
@@ -1,68 +1,197 @@
+import eventlet
 import requests
 import json
 import re
+import hashlib
+import collections
+import numpy as np
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:  # pragma: no cover - orjson is in requirements
+    _loads = json.loads
+    _dumps = lambda obj: json.dumps(obj).encode()
+
+# requests skips body encoding when handed bytes via data=, but then needs
+# the content type spelled out
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Compiled once at import - re.search with a literal pattern re-checks the
+# regex cache on every call
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+_ENGLISH_WORD_RE = re.compile(r"[a-zA-Z]+")
 
 
 class LLMHandler:
     def __init__(self):
         
         self.ollama_url = "http://ollama-service:11434/api/generate"
-        self.chat_model = "qwen2.5:1.5b"
-        self.feedback_model = "qwen2.5:3b"
+        self.chat_model = "qwen2.5:1.5b-instruct-q4_K_M"
+        self.feedback_model = "qwen2.5:3b-instruct-q4_K_M"
         self.hsk_level = "4" # tune feedback highlighting for which hsk levels
+        self._feedback_system = self._build_feedback_system()
 
-    
-    def get_response(self, user_message, conversation_history):
-        """Get user llm chat response"""
+        # Pooled session so back-to-back Ollama calls reuse the same socket
+        # instead of paying a TCP handshake per request
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+        # Semantic reply cache: recent (embedding, reply) pairs so a
+        # near-identical prompt reuses an earlier answer without generating
+        self.embed_url = "http://ollama-service:11434/api/embeddings"
+        self.embed_model = "nomic-embed-text"
+        self._semantic_cache = collections.deque(maxlen=256)
+        self._semantic_threshold = 0.92
+
+        # LRU cache for near-deterministic (low temperature) generations,
+        # keyed by a hash of (model, temperature, prompt)
+        self._resp_cache = collections.OrderedDict()
+        self._resp_cache_max = 512
+        self.cache_stats = {"hits": 0, "misses": 0}
+
+        # Token context returned by Ollama, keyed by session id - passing it
+        # back lets the server resume from cached KV state instead of
+        # re-prefilling the whole history. Per session, or concurrent chats
+        # would resume from (and leak) each other's conversations
+        self._chat_context: Dict[str, List[int]] = {}
+
+        self._warm_chat_model()
+
+    def _warm_chat_model(self) -> None:
+        """Issue a one-token generation so boot, not the first user turn,
+        pays the model cold-load. Best effort - Ollama may still be coming up."""
         try:
-            context = self._build_context(conversation_history)
-
-            system_prompt = (
-                f"<system>\n"
-                f"你是用户的中文朋友，用自然、轻松的方式聊天。"
-                f"像真正的朋友一样交流——分享想法、回应感受、延续话题。\n\n"
-                f"对话风格：\n"
-                f"- 用日常口语（HSK4-6难度），像朋友聊天一样自然\n"
-                f"- 回应用户说的内容，表达真实的反应和想法\n"
-                f"- 提问要出于好奇，不是为了教学——就像朋友想了解更多\n"
-                f"- 偶尔分享你的'想法'或'经历'让对话更真实\n"
-                f"- 保持简短自然，一两句话就够了\n\n"
-                f"处理用户的中文：\n"
-                f"- 永远不要明确纠错或打断对话流\n"
-                f"- 如果用户的表达很不自然或很奇怪，你可以在回应中自然地用正确说法重复那个意思\n"
-                f"  例如：用户说'我昨天去了看电影'，你说'哦真的吗？你昨天看了什么电影？'\n"
-                f"- 只在表达真的很不自然时才这样做，不要每次都重复\n"
-                f"- 如果用户混了英文词，可以自然地用中文说那个词，但要像朋友提醒，不是老师纠正\n\n"
-                f"记住：你不是老师或面试官，你是朋友。让对话自然流动。"
-                f"</system>"
+            self.session.post(
+                self.ollama_url,
+                json={
+                    "model": self.chat_model,
+                    "prompt": "你好",
+                    "stream": False,
+                    "keep_alive": "30m",
+                    "options": {"num_predict": 1},
+                },
+                timeout=60,
             )
+        except Exception as e:
+            print(f"Chat model warmup skipped: {e}")
 
-            prompt = (
-                f"{system_prompt}\n"
-                f"<conversation>\n"
-                f"{context}\n"
-                f"</conversation>\n"  
-                f"<user>{user_message}</user>\n"
-                f"<assistant>"
-            )
+    
+    def get_response(self, user_message: str, conversation_history: List[Dict], session_id: str = "default") -> str:
+        """Get user llm chat response (collects the streamed chunks)."""
+        try:
+            # Embed the message (plus a little recent context) and reuse a
+            # cached reply when a near-identical prompt was answered before
+            probe = self._semantic_probe_text(user_message, conversation_history)
+            query_vec = self._embed(probe)
+            cached_reply = self._semantic_lookup(query_vec)
+            if cached_reply is not None:
+                # The reply bypassed generation, so the server-side KV state
+                # no longer matches this session's recorded history - force
+                # a full-prompt rebuild on the next turn
+                self.reset_context(session_id)
+                return cached_reply
 
-            response = self._call_ollama(self.chat_model, prompt, 0.9, 0.9, keep_alive="5m")
+            result_text = "".join(
+                self.stream_response(user_message, conversation_history, session_id)
+            ).strip()
 
-            if response.status_code != 200:
+            if not result_text:
                 return "抱歉，我好像遇到一点问题，你可以再说一次吗？"
 
-            result_text = self._safe_parse_response(response).strip()
-
             if not self._looks_like_mandarin(result_text):
                 result_text = "我再说一遍：" + result_text
 
+            if query_vec is not None:
+                self._semantic_cache.append((query_vec, result_text))
+
             return result_text
 
         except Exception as e:
             return "系统好像连不上，你可以再试一次吗？"
 
+    def stream_response(self, user_message: str, conversation_history: List[Dict], session_id: str = "default") -> Iterator[str]:
+        """Stream the chat response chunk by chunk as Ollama generates it.
+
+        Yields text fragments so callers can forward them to the UI as soon
+        as the first token arrives instead of waiting for the full reply.
+        """
+        context = self._chat_context.get(session_id)
+        prompt = self._build_chat_prompt(user_message, conversation_history,
+                                         has_context=context is not None)
+
+        payload = {
+            "model": self.chat_model,
+            "prompt": prompt,
+            "stream": True,
+            "keep_alive": "30m",
+            "options": {
+                "num_ctx": 2048,
+                "temperature": 0.9,
+                "top_p": 0.9,
+            }
+        }
+        if context is not None:
+            payload["context"] = context
+
+        with self.session.post(self.ollama_url, data=_dumps(payload),
+                               headers=_JSON_HEADERS, stream=True, timeout=300) as response:
+            if response.status_code != 200:
+                return
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                obj = _loads(line)
+                if obj.get("context"):
+                    self._chat_context[session_id] = obj["context"]
+                chunk = obj.get("response", "")
+                if chunk:
+                    yield chunk
+
+    def _build_chat_prompt(self, user_message: str, conversation_history: List[Dict], has_context: bool = False) -> str:
+        """Build the chat prompt, skipping the history when KV context is cached."""
+        if has_context:
+            # Server already holds the history in KV cache - only send the new turn
+            return (
+                f"<user>{user_message}</user>\n"
+                f"<assistant>"
+            )
+
+        system_prompt = (
+            f"<system>\n"
+            f"你是用户的中文朋友，用自然、轻松的方式聊天。"
+            f"像真正的朋友一样交流——分享想法、回应感受、延续话题。\n\n"
+            f"对话风格：\n"
+            f"- 用日常口语（HSK4-6难度），像朋友聊天一样自然\n"
+            f"- 回应用户说的内容，表达真实的反应和想法\n"
+            f"- 提问要出于好奇，不是为了教学——就像朋友想了解更多\n"
+            f"- 偶尔分享你的'想法'或'经历'让对话更真实\n"
+            f"- 保持简短自然，一两句话就够了\n\n"
+            f"处理用户的中文：\n"
+            f"- 永远不要明确纠错或打断对话流\n"
+            f"- 如果用户的表达很不自然或很奇怪，你可以在回应中自然地用正确说法重复那个意思\n"
+            f"  例如：用户说'我昨天去了看电影'，你说'哦真的吗？你昨天看了什么电影？'\n"
+            f"- 只在表达真的很不自然时才这样做，不要每次都重复\n"
+            f"- 如果用户混了英文词，可以自然地用中文说那个词，但要像朋友提醒，不是老师纠正\n\n"
+            f"记住：你不是老师或面试官，你是朋友。让对话自然流动。"
+            f"</system>"
+        )
+
+        context = self._build_context(conversation_history)
+        return (
+            f"{system_prompt}\n"
+            f"<conversation>\n"
+            f"{context}\n"
+            f"</conversation>\n"
+            f"<user>{user_message}</user>\n"
+            f"<assistant>"
+        )
+
     # user feedback model to correct sentences
-    def correct_sentence(self, broken_sentence):
+    def correct_sentence(self, broken_sentence: str) -> Dict:
         """
         NEW: Natural correction with smart highlighting.
         
@@ -81,14 +210,150 @@ class LLMHandler:
         """
         
         # Extract English words to hint to the LLM
-        english_words = re.findall(r'[a-zA-Z]+', broken_sentence)
+        # dict.fromkeys dedupes repeated words while keeping first-seen order
+        english_words = list(dict.fromkeys(_ENGLISH_WORD_RE.findall(broken_sentence)))
         english_hint = f"\n注意：用户用英文说了这些词：{', '.join(english_words)}" if english_words else ""
-        
-        # Build the new prompt
-        prompt = f"""你是经验丰富的中文老师。学生（中级水平，HSK 3-6）说了：
 
+        # The instructions and worked examples ride in the system field (built
+        # once in __init__) so Ollama's prefix cache skips their prefill on
+        # every call after the first; only the sentence itself is new tokens
+        prompt = f"""学生说了：
 "{broken_sentence}"{english_hint}
 
+输出JSON："""
+
+        try:
+            raw = self._generate_cached(
+                self.feedback_model, prompt, 0.3, 0.9, 0,
+                num_predict=512, format="json", system=self._feedback_system
+            ).strip()
+            
+            # Clean and parse JSON
+            parsed = self._parse_json_or_fallback(raw)
+            
+            # Validate structure
+            if not parsed.get('corrected'):
+                parsed['corrected'] = broken_sentence
+            if 'highlights' not in parsed:
+                parsed['highlights'] = []
+            if 'note' not in parsed:
+                parsed['note'] = ''
+        
+            
+            return parsed
+            
+        except Exception as e:
+            return {
+                "corrected": broken_sentence,
+                "highlights": [],
+                "note": f"Error: {str(e)}"
+            }
+
+    def correct_sentences(self, broken_sentences: List[str]) -> List[Dict]:
+        """Correct several sentences with one feedback-model call.
+
+        Packing the batch into a numbered list costs one model swap and one
+        prefill per session instead of one per sentence. Each result carries
+        an idx so answers map back even if the model reorders or drops one;
+        anything missing falls back to the original sentence unchanged.
+        """
+        if not broken_sentences:
+            return []
+        if len(broken_sentences) == 1:
+            return [self.correct_sentence(broken_sentences[0])]
+
+        numbered = "\n".join(
+            f'{i}. "{sentence}"' for i, sentence in enumerate(broken_sentences, 1)
+        )
+        prompt = f"""学生说了这些句子：
+{numbered}
+
+对每个句子按规则输出一个对象，多加一个 idx 字段（从1开始），全部放进 results 数组。
+
+输出JSON（格式：{{"results": [...]}}）："""
+
+        fallbacks = [
+            {"corrected": sentence, "highlights": [], "note": ""}
+            for sentence in broken_sentences
+        ]
+
+        try:
+            raw = self._generate_cached(
+                self.feedback_model, prompt, 0.3, 0.9, 0,
+                num_predict=256 * len(broken_sentences), format="json",
+                system=self._feedback_system
+            ).strip()
+
+            parsed = self._parse_json_or_fallback(raw)
+            results = parsed.get("results")
+            if not isinstance(results, list):
+                raise ValueError("expected a results array")
+
+            out = fallbacks
+            for pos, item in enumerate(results):
+                if not isinstance(item, dict):
+                    continue
+                idx = item.get("idx")
+                i = idx - 1 if isinstance(idx, int) else pos
+                if not 0 <= i < len(out):
+                    continue
+                out[i] = {
+                    "corrected": item.get("corrected") or broken_sentences[i],
+                    "highlights": item.get("highlights", []),
+                    "note": item.get("note", ""),
+                }
+            return out
+
+        except Exception as e:
+            return [
+                {"corrected": sentence, "highlights": [], "note": f"Error: {str(e)}"}
+                for sentence in broken_sentences
+            ]
+
+    def _semantic_probe_text(self, user_message: str, conversation_history: List[Dict]) -> str:
+        """Text to embed for the semantic cache - includes the last two turns
+        so similar messages in unrelated dialogs don't collide."""
+        recent = [msg.get("content", "") for msg in list(conversation_history)[-2:]]
+        recent.append(user_message)
+        return "\n".join(recent)
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Embed text via Ollama; returns a unit vector or None on failure."""
+        try:
+            response = self.session.post(
+                self.embed_url,
+                json={"model": self.embed_model, "prompt": text},
+                timeout=10,
+            )
+            if response.status_code != 200:
+                return None
+            vec = np.asarray(response.json()["embedding"], dtype=np.float32)
+            norm = np.linalg.norm(vec)
+            if norm == 0:
+                return None
+            return vec / norm
+        except Exception:
+            return None
+
+    def _semantic_lookup(self, query_vec: Optional[np.ndarray]) -> Optional[str]:
+        """Return a cached reply if a stored prompt is similar enough."""
+        if query_vec is None or not self._semantic_cache:
+            return None
+        matrix = np.stack([vec for vec, _ in self._semantic_cache])
+        scores = matrix @ query_vec
+        best = int(np.argmax(scores))
+        if scores[best] >= self._semantic_threshold:
+            return self._semantic_cache[best][1]
+        return None
+
+    def _build_feedback_system(self) -> str:
+        """Static instructions + worked examples for the feedback model.
+
+        Sent as the Ollama system field so its ~800 tokens are prefix-cached
+        server-side instead of re-prefilled with every correction.
+        """
+        return f"""你是经验丰富的中文老师。学生（中级水平，HSK 3-6）会给你一个句子。
+
 任务：
 1. 改成母语者会说的自然句子
 2. 标注值得学习的词汇（新词、搭配、量词、习语等）
@@ -180,46 +445,50 @@ class LLMHandler:
     {{"word": "用...打", "meaning": "to hit with (using...)", "why": "常用结构", "category": "collocation"}}
   ],
   "note": "注意：bat 有两个意思（球棒/蝙蝠）"
-}}
+}}"""
 
-现在处理：
-"{broken_sentence}"
+    def _generate_cached(self, model: str, prompt: str, temperature: float = 0.2, top_p: float = 0.9, keep_alive="5m", num_predict: Optional[int] = None, stop: Optional[List[str]] = None, format: Optional[str] = None, system: Optional[str] = None) -> str:
+        """Call Ollama, caching results for prompts that are near-deterministic.
 
-输出JSON："""
+        Only generations with temperature <= 0.3 are cached; hits skip the
+        network (and the chat-model unload) entirely.
+        """
+        cacheable = temperature <= 0.3
+        if cacheable:
+            key = hashlib.sha256(
+                f"{model}\x00{temperature}\x00{prompt}".encode()
+            ).hexdigest()
+            cached = self._resp_cache.get(key)
+            if cached is not None:
+                self._resp_cache.move_to_end(key)
+                self.cache_stats["hits"] += 1
+                return cached
+            self.cache_stats["misses"] += 1
 
-        try:
-            # Unload chat model, load feedback model
-            requests.post(self.ollama_url, json={"model": self.chat_model, "keep_alive": 0})
-            
-            response = self._call_ollama(self.feedback_model, prompt, 0.3, 0.9, 0)
-            raw = self._safe_parse_response(response).strip()
-            
-            # Clean and parse JSON
-            parsed = self._parse_json_or_fallback(raw)
-            
-            # Validate structure
-            if not parsed.get('corrected'):
-                parsed['corrected'] = broken_sentence
-            if 'highlights' not in parsed:
-                parsed['highlights'] = []
-            if 'note' not in parsed:
-                parsed['note'] = ''
-        
-            
-            return parsed
-            
-        except Exception as e:
-            return {
-                "corrected": broken_sentence,
-                "highlights": [],
-                "note": f"Error: {str(e)}"
-            }
+        response = self._call_ollama(model, prompt, temperature, top_p, keep_alive,
+                                     num_predict=num_predict, stop=stop, format=format, system=system)
+        raw, _ = self._safe_parse_response(response)
+
+        if cacheable and raw:
+            self._resp_cache[key] = raw
+            if len(self._resp_cache) > self._resp_cache_max:
+                self._resp_cache.popitem(last=False)
+
+        return raw
+
+    def reset_context(self, session_id: Optional[str] = None) -> None:
+        """Drop the cached token context for one session, or all of them."""
+        if session_id is None:
+            self._chat_context.clear()
+        else:
+            self._chat_context.pop(session_id, None)
 
     # helper functions
-    def _build_context(self, history):
+    def _build_context(self, history: List[Dict]) -> str:
         """Converts conversation history into XML-tag structure."""
         formatted = []
-        for msg in history[-8:]:
+        # list() first: histories are deques, which don't support slicing
+        for msg in list(history)[-8:]:
             if msg["role"] == "user":
                 formatted.append(f"<user>{msg['content']}</user>")
             else:
@@ -229,37 +498,32 @@ class LLMHandler:
     def _safe_parse_response(self, response):
         """ensure response from llm is valid and usable"""
         try:
-            data = response.json()
-            return data.get("response", "")
+            data = _loads(response.content)
+            return data.get("response", ""), data.get("context")
         except Exception as e:
             print(f"Parsing error: {e}")
-            return ""
+            return "", None
 
-    def _looks_like_mandarin(self, text):
+    def _looks_like_mandarin(self, text: str) -> bool:
         """Check if output contains Chinese characters."""
-        return bool(re.search(r"[\u4e00-\u9fff]", text))
+        return bool(_CJK_RE.search(text))
 
-    def _parse_json_or_fallback(self, text):
-        """Try to parse JSON from model output, with fallback."""
-        text = text.strip()
-        text = text.replace("```json", "").replace("```", "")
-        
+    def _parse_json_or_fallback(self, text: str) -> Dict:
+        """Parse model JSON output, with a defensive fallback.
+
+        Ollama's JSON mode guarantees valid JSON and no code fences, so the
+        old fence-stripping and DOTALL blob-extraction regex are gone.
+        """
         try:
-            return json.loads(text)
-        except:
-            match = re.search(r'\{.*\}', text, re.DOTALL)
-            if match:
-                try:
-                    return json.loads(match.group(0))
-                except:
-                    pass
+            return _loads(text)
+        except Exception:
             return {
                 "corrected": text,
                 "highlights": [],
                 "note": "解析错误"
             }
             
-    def _call_ollama(self, model, prompt, temperature=0.2, top_p=0.9, keep_alive="5m"):
+    def _call_ollama(self, model: str, prompt: str, temperature: float = 0.2, top_p: float = 0.9, keep_alive="5m", context: Optional[List[int]] = None, num_predict: Optional[int] = None, stop: Optional[List[str]] = None, format: Optional[str] = None, system: Optional[str] = None):
         """Unified caller to handle VRAM memory swap."""
         payload = {
             "model": model,
@@ -267,20 +531,45 @@ class LLMHandler:
             "stream": False,
             "keep_alive": keep_alive,
             "options": {
-                "num_ctx": 2048,
+                # The feedback model takes batched correction prompts whose
+                # system examples + sentences approach 2048 tokens
+                "num_ctx": 4096 if model == self.feedback_model else 2048,
                 "temperature": temperature,
                 "top_p": top_p,
             }
         }
-        
+        # Generation time is roughly linear in emitted tokens - cap it
+        # server-side for prompts with a known-short answer
+        if num_predict is not None:
+            payload["options"]["num_predict"] = num_predict
+        if stop is not None:
+            payload["options"]["stop"] = stop
+        if context is not None:
+            payload["context"] = context
+        if format is not None:
+            payload["format"] = format
+        if system is not None:
+            payload["system"] = system
+
         try:
-            response = requests.post(self.ollama_url, json=payload, timeout=300)
+            # Fire the chat-model unload without waiting for its response:
+            # Ollama serializes the swap internally, so overlapping the two
+            # requests hides the unload round-trip behind the 3B dispatch
+            if model == self.feedback_model:
+                eventlet.spawn_n(
+                    self.session.post,
+                    self.ollama_url,
+                    json={"model": self.chat_model, "keep_alive": 0},
+                )
+
+            response = self.session.post(self.ollama_url, data=_dumps(payload),
+                                         headers=_JSON_HEADERS, timeout=300)
             
             # Check if model exists
             if response.status_code == 404:
                 print(f"Model {model} not found. Available models:")
                 try:
-                    models_response = requests.get("http://ollama-service:11434/api/tags")
+                    models_response = self.session.get("http://ollama-service:11434/api/tags")
                     print(models_response.json())
                 except:
                     pass
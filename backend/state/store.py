@@ -1,3 +1,5 @@
+from collections import defaultdict, deque
+
 from backend.services.llm_handler import LLMHandler
 from backend.services.feedback_gen import FeedbackGenerator
 
@@ -7,4 +9,7 @@ feedback = FeedbackGenerator(llm)
 
 # Shared state dictionaries (moved from store.py)
 transcripts = {}
-conversation_histories = {}
+# Bounded per session: appends past 16 turns evict the oldest, so a
+# long-running chat can't grow its history without limit (the prompt
+# builder never looks further back than 8 turns anyway)
+conversation_histories = defaultdict(lambda: deque(maxlen=16))